@@ -1,3 +1,41 @@
-import os  # noqa: F401
+import os
 
-OLLAMA_API_URL = "http://localhost:11434"
+# Dump full LLM results (OCR items, categories, advice) to the log at DEBUG level.
+# Off by default: with a DEBUG sink the dump would run for every message.
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "0").lower() in ("1", "true", "yes")
+
+OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://ollama:11434")
+
+# Keep-alive connections kept per Ollama host; must be >= worker concurrency,
+# otherwise extra connections are dropped after each request
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "10"))
+
+# (connect, read) timeouts in seconds; with streaming the read timeout is the
+# longest allowed pause between chunks, not the whole generation
+OLLAMA_TIMEOUT = (
+    float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("OLLAMA_READ_TIMEOUT", "300")),
+)
+# Backoff between retries of a failed/timed out request
+OLLAMA_RETRY_DELAYS = (1, 2, 4)
+# Overall budget for one chat() call in seconds, retries included: past it the
+# stream is closed (Ollama stops generating) and no further attempt is made
+OLLAMA_DEADLINE = float(os.getenv("OLLAMA_DEADLINE", "600"))
+
+# Generation settings sent with every /api/chat request. A fixed num_ctx keeps
+# Ollama from falling back to its 2048 default (and from reloading the model
+# when callers disagree); keep_alive keeps the model resident between tasks.
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "8192"))
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "2048"))
+OLLAMA_TEMPERATURE = float(os.getenv("OLLAMA_TEMPERATURE", "0.2"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+OLLAMA_OPTIONS = {
+    "num_ctx": OLLAMA_NUM_CTX,
+    "num_predict": OLLAMA_NUM_PREDICT,
+    "temperature": OLLAMA_TEMPERATURE,
+}
+
+# Larger receipt photos are downscaled to this many pixels before OCR: the
+# vision encoder cost grows with image area, not with the longest side.
+OCR_MAX_IMAGE_PIXELS = int(os.getenv("OCR_MAX_IMAGE_PIXELS", str(1024 * 1024)))
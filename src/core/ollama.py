@@ -0,0 +1,141 @@
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import orjson
+
+from src.core.config import (
+    OLLAMA_API_URL,
+    OLLAMA_DEADLINE,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_NUM_PREDICT,
+    OLLAMA_OPTIONS,
+    OLLAMA_POOL_SIZE,
+    OLLAMA_RETRY_DELAYS,
+    OLLAMA_TIMEOUT,
+)
+from src.core.logging import logger
+
+if TYPE_CHECKING:
+    import requests
+
+CHAT_URL = f"{OLLAMA_API_URL}/api/chat"
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def dumps_compact(data: dict) -> str:
+    """Serialize prompt context without indentation (fewer tokens for the LLM)."""
+    return orjson.dumps(data).decode("utf-8")
+
+
+_session: "requests.Session | None" = None
+_session_lock = threading.Lock()
+# requests.ConnectionError/Timeout, filled in by get_session() with the lazy import
+_retryable_errors: tuple[type[Exception], ...] = ()
+
+
+def get_session() -> "requests.Session":
+    """
+    Return the process-wide session, creating it on first use.
+    requests is imported here so that importing the services stays cheap.
+    """
+    global _session, _retryable_errors
+    session = _session
+    if session is None:
+        with _session_lock:
+            session = _session
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                # Every service shares one pool of keep-alive connections to
+                # Ollama. Ollama serves plain HTTP/1.1 (no h2c), so pooled
+                # keep-alive is what we get.
+                session = requests.Session()
+                session.mount(
+                    "http://",
+                    HTTPAdapter(
+                        pool_connections=10,
+                        pool_maxsize=OLLAMA_POOL_SIZE,
+                        max_retries=0,
+                    ),
+                )
+                _retryable_errors = (requests.ConnectionError, requests.Timeout)
+                _session = session
+    return session
+
+
+def _read_stream(session: "requests.Session", body: bytes, deadline: float) -> str:
+    """
+    POST a streaming /api/chat request and join the NDJSON chunks
+    into the full message content. Gives up once time.monotonic() passes deadline.
+    """
+    parts: list[str] = []
+    done_reason = None
+    # Read timeout applies between chunks, so only a stalled model trips it;
+    # it is capped so that a stall cannot outlast the deadline either
+    connect_timeout, read_timeout = OLLAMA_TIMEOUT
+    remaining = max(deadline - time.monotonic(), 0.001)
+    timeout = (connect_timeout, min(read_timeout, remaining))
+    with session.post(
+        CHAT_URL, data=body, headers=_JSON_HEADERS, stream=True, timeout=timeout
+    ) as resp:
+        resp.raise_for_status()
+        # iter_lines buffers partial lines between network chunks. Read to the
+        # end (no break on "done"): only a fully read response goes back to the pool
+        for line in resp.iter_lines():
+            if time.monotonic() > deadline:
+                # Leaving the with-block closes the stream and Ollama stops generating
+                raise TimeoutError(
+                    f"Ollama request exceeded the {OLLAMA_DEADLINE:g}s deadline"
+                )
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(f"Ollama error: {chunk['error']}")
+            parts.append(chunk.get("message", {}).get("content", ""))
+            if chunk.get("done"):
+                done_reason = chunk.get("done_reason")
+                logger.debug(
+                    f"Ollama {chunk.get('model')}: {chunk.get('eval_count')} tokens "
+                    f"in {chunk.get('eval_duration', 0) / 1e9:.1f}s "
+                    f"(total {chunk.get('total_duration', 0) / 1e9:.1f}s)"
+                )
+    if done_reason == "length":
+        # Otherwise the caller only sees a JSONDecodeError on half a document
+        raise RuntimeError(
+            f"Ollama output was cut off at num_predict={OLLAMA_NUM_PREDICT} tokens "
+            f"(raise OLLAMA_NUM_PREDICT)"
+        )
+    return "".join(parts)
+
+
+def chat(model: str, messages: list[dict], schema: dict) -> dict:
+    """
+    Run a structured-output /api/chat request and return the parsed JSON content.
+    Connection errors and timeouts are retried with backoff, all within
+    OLLAMA_DEADLINE seconds.
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "format": schema,
+        "options": OLLAMA_OPTIONS,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+    }
+    body = orjson.dumps(payload)
+    session = get_session()
+    deadline = time.monotonic() + OLLAMA_DEADLINE
+
+    for delay in OLLAMA_RETRY_DELAYS:
+        try:
+            return orjson.loads(_read_stream(session, body, deadline))
+        except _retryable_errors as e:
+            if time.monotonic() + delay >= deadline:
+                raise
+            logger.warning(f"Ollama недоступна ({e}), повтор через {delay}s")
+            time.sleep(delay)
+    return orjson.loads(_read_stream(session, body, deadline))
@@ -1,17 +1,22 @@
-import json
+from functools import lru_cache
 from pathlib import Path
-import requests
 
-OLLAMA_API_URL = "http://ollama:11434"
+import orjson
 
+from src.core import ollama
 
+_SYSTEM_MESSAGE = {"role": "system", "content": "Вы финансовый помощник."}
+
+
+@lru_cache(maxsize=64)
 def load_json(path: str) -> dict:
-    """Load JSON file from disk."""
-    return json.loads(Path(path).read_text(encoding="utf-8"))
+    """Load JSON file from disk (cached per process, do not mutate the result)."""
+    return orjson.loads(Path(path).read_bytes())
 
 
+@lru_cache(maxsize=64)
 def load_prompt(path: str) -> str:
-    """Load prompt text from disk."""
+    """Load prompt text from disk (cached per process)."""
     return Path(path).read_text(encoding="utf-8").strip()
 
 
@@ -26,8 +31,6 @@ def generate_advice(
     Generate 3-6 actionable financial advice items for the given goal and monthly statistics.
     Returns a dict matching the advice schema.
     """
-    url = f"{OLLAMA_API_URL}/api/chat"
-
     # Загружаем схему и промпт
     schema = load_json(schema_path)
     prompt = load_prompt(prompt_path)
@@ -39,25 +42,14 @@ def generate_advice(
     }
 
     messages = [
-        {"role": "system", "content": "Вы финансовый помощник."},
+        _SYSTEM_MESSAGE,
         {
             "role": "user",
-            "content": f"{prompt}\n\nКонтекст:\n{json.dumps(input_context, ensure_ascii=False, indent=2)}"
+            "content": f"{prompt}\n\nКонтекст:\n{ollama.dumps_compact(input_context)}"
         }
     ]
 
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": False,
-        "format": schema
-    }
-
-    resp = requests.post(url, json=payload)
-    resp.raise_for_status()
-
-    content_str = resp.json()["message"]["content"]
-    advice_result = json.loads(content_str)
+    advice_result = ollama.chat(model, messages, schema)
 
     # Проверка, что есть ключ 'advice'
     if "advice" not in advice_result:
@@ -0,0 +1,13 @@
+from src.services.ocr.ocr import (
+    categorize_items,
+    categorize_items_batch,
+    extract_text_from_base64_image,
+    extract_text_from_image_bytes,
+)
+
+__all__ = [
+    "extract_text_from_base64_image",
+    "extract_text_from_image_bytes",
+    "categorize_items",
+    "categorize_items_batch",
+]
@@ -1,84 +1,173 @@
 import base64
-import json
+import io
+from functools import lru_cache
 from pathlib import Path
 
-import requests
+import orjson
+from PIL import Image, ImageOps
 
-OLLAMA_API_URL = "http://ollama:11434"
+from src.core import ollama
+from src.core.config import OCR_MAX_IMAGE_PIXELS
 
+_CATEGORIZE_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "You are a categorization assistant.",
+}
 
+
+@lru_cache(maxsize=64)
 def load_json(path: str) -> dict:
-    """Load JSON file from disk."""
-    return json.loads(Path(path).read_text(encoding="utf-8"))
+    """Load JSON file from disk (cached per process, do not mutate the result)."""
+    return orjson.loads(Path(path).read_bytes())
 
 
+@lru_cache(maxsize=64)
 def load_prompt(path: str) -> str:
-    """Load prompt text from disk."""
+    """Load prompt text from disk (cached per process)."""
     return Path(path).read_text(encoding="utf-8").strip()
 
 
-def extract_text_from_base64_image(
-        image_b64: str, model: str, schema_path: str, prompt_path: str
-) -> dict:
+def downscale_image(image: bytes, max_pixels: int = OCR_MAX_IMAGE_PIXELS) -> bytes:
     """
-    Extract structured text (Name, Price, Description) from an image encoded in Base64
-    using Ollama multimodal model. Returns a Python dict.
+    Shrink an image to at most max_pixels pixels and re-encode it as JPEG.
+    Images that already fit are returned unchanged (the same object).
     """
-    url = f"{OLLAMA_API_URL}/api/chat"
+    picture: Image.Image = Image.open(io.BytesIO(image))
+    width, height = picture.size
+    if width * height <= max_pixels:
+        return image
 
-    # Теперь мы принимаем image_b64 напрямую, без чтения файла
+    # Phone photos carry rotation in EXIF; apply it before JPEG drops the tag
+    picture = ImageOps.exif_transpose(picture) or picture
+    width, height = picture.size
+    scale = (max_pixels / (width * height)) ** 0.5
+    picture.thumbnail((max(1, int(width * scale)), max(1, int(height * scale))))
 
+    buf = io.BytesIO()
+    picture.convert("RGB").save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def downscale_image_b64(image_b64: str, max_pixels: int = OCR_MAX_IMAGE_PIXELS) -> str:
+    """Base64 variant of downscale_image; returns the input string if it already fits."""
+    image = base64.b64decode(image_b64)
+    resized = downscale_image(image, max_pixels)
+    if resized is image:
+        return image_b64
+    return base64.b64encode(resized).decode("ascii")
+
+
+def _extract_text(
+    image_b64: str, model: str, schema_path: str, prompt_path: str
+) -> dict:
     schema = load_json(schema_path)
     prompt = load_prompt(prompt_path)
 
     messages = [{"role": "user", "content": prompt, "images": [image_b64]}]
 
-    payload = {"model": model, "messages": messages, "stream": False, "format": schema}
+    return ollama.chat(model, messages, schema)
 
-    resp = requests.post(url, json=payload)
-    resp.raise_for_status()
 
-    content_str = resp.json()["message"]["content"]
-    return json.loads(content_str)
+def extract_text_from_base64_image(
+    image_b64: str, model: str, schema_path: str, prompt_path: str
+) -> dict:
+    """
+    Extract structured text (Name, Price, Description) from an image encoded in Base64
+    using Ollama multimodal model. Returns a Python dict.
+    """
+    # Теперь мы принимаем image_b64 напрямую, без чтения файла
+    return _extract_text(
+        downscale_image_b64(image_b64), model, schema_path, prompt_path
+    )
+
+
+def extract_text_from_image_bytes(
+    image: bytes, model: str, schema_path: str, prompt_path: str
+) -> dict:
+    """
+    Same as extract_text_from_base64_image, for raw image bytes
+    (e.g. from a MessagePack task). Returns a Python dict.
+    """
+    image_b64 = base64.b64encode(downscale_image(image)).decode("ascii")
+    return _extract_text(image_b64, model, schema_path, prompt_path)
 
 
 def categorize_items(
     ocr_result: dict,
     categories: list[str],
     model: str,
-    schema_path: str,
+    schema: dict,
     prompt_path: str,
 ) -> dict:
     """
     Assign a category from the provided list to each OCR item using Ollama.
+    The schema must already list the categories in the Category enum; it is not modified.
     Returns a Python dict with 'Category' field added.
     """
-    url = f"{OLLAMA_API_URL}/api/chat"
+    prompt = load_prompt(prompt_path)
 
-    schema = load_json(schema_path)
+    messages = [
+        _CATEGORIZE_SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": f"{prompt}\n\nAvailable categories: "
+            f"{categories}\n\n"
+            f"Items:\n{ollama.dumps_compact(ocr_result)}",
+        },
+    ]
 
-    # Inject allowed categories into enum
-    if "items" in schema["properties"]:
-        item_props = schema["properties"]["items"]["items"]["properties"]
-        if "Category" in item_props:
-            item_props["Category"]["enum"] = categories
+    return ollama.chat(model, messages, schema)
+
+
+def categorize_items_batch(
+    ocr_results: list[dict],
+    categories: list[str],
+    model: str,
+    schema: dict,
+    prompt_path: str,
+) -> list[dict]:
+    """
+    Categorize several OCR results in a single Ollama request.
+    Takes the same per-receipt schema as categorize_items.
+    Returns one dict per OCR result, in the same order, as categorize_items would.
+    """
+    receipt_schema = {key: value for key, value in schema.items() if key != "$schema"}
+
+    count = len(ocr_results)
+    batch_schema = {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": receipt_schema,
+                "minItems": count,
+                "maxItems": count,
+            }
+        },
+        "required": ["results"],
+    }
 
     prompt = load_prompt(prompt_path)
+    receipts = [
+        {"receipt": index, "items": ocr_result.get("items", [])}
+        for index, ocr_result in enumerate(ocr_results)
+    ]
 
     messages = [
-        {"role": "system", "content": "You are a categorization assistant."},
+        _CATEGORIZE_SYSTEM_MESSAGE,
         {
             "role": "user",
             "content": f"{prompt}\n\nAvailable categories: "
             f"{categories}\n\n"
-            f"Items:\n{json.dumps(ocr_result, indent=2, ensure_ascii=False)}",
+            f"Receipts (return one result per receipt, in the same order):\n"
+            f"{ollama.dumps_compact({'receipts': receipts})}",
         },
     ]
 
-    payload = {"model": model, "messages": messages, "stream": False, "format": schema}
-
-    resp = requests.post(url, json=payload)
-    resp.raise_for_status()
+    results = ollama.chat(model, messages, batch_schema).get("results", [])
+    if len(results) != count:
+        raise ValueError(
+            "Количество результатов категоризации не совпадает с количеством чеков"
+        )
 
-    content_str = resp.json()["message"]["content"]
-    return json.loads(content_str)
+    return results
@@ -1,9 +1,11 @@
-import json
 import os
-import pika
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+import orjson
 from src.services.advice.llm_utils import generate_advice  # убедись, что llm_utils есть в advice
 from src.core import logging  # импорт logger через пакет
+from src.core.config import LOG_PAYLOADS
 
 logger = logging.logger
 
@@ -14,93 +16,116 @@ RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
 RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
 
 ADVICE_MODEL = os.getenv("ADVICE_MODEL", "qwen3:14b")
+# Сколько задач обрабатывается параллельно (держать равным OLLAMA_NUM_PARALLEL)
+ADVICE_WORKERS = int(os.getenv("ADVICE_WORKERS", "4"))
 
 ADVICE_SCHEMA = BASE_DIR / "src/services/advice/schemas/advice_schema.json"
 ADVICE_PROMPT = BASE_DIR / "src/services/advice/prompts/advice_prompt.txt"
 
+# Сервис принимает пути строками — переводим один раз, а не на каждую задачу
+ADVICE_SCHEMA_PATH = str(ADVICE_SCHEMA)
+ADVICE_PROMPT_PATH = str(ADVICE_PROMPT)
+
 ADVICE_QUEUE = "advice_tasks"
 ADVICE_RESULTS_QUEUE = "advice_results"
 
 
 def start_advice_worker():
-    logger.info(f"--- Запуск Advice Worker. RabbitMQ: {RABBITMQ_HOST} ---")
+    # pika нужен только запущенному воркеру — не тянем его при импорте модуля
+    import pika
 
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=5672,
-                credentials=credentials,
-                heartbeat=60000
-            )
-        )
-    except pika.exceptions.AMQPConnectionError as e:
-        logger.error(f"Не удалось подключиться к RabbitMQ: {e}")
-        return
-
-    channel = connection.channel()
-    channel.queue_declare(queue=ADVICE_QUEUE, durable=True)
-    channel.queue_declare(queue=ADVICE_RESULTS_QUEUE, durable=True)
-
-    def process_task(ch, method, properties, body):
-        logger.info("RAW advice message received")
-        task_id = "N/A"
-
-        try:
-            task = json.loads(body.decode("utf-8"))
-            task_id = task.get("task_id", "N/A")
-
-            goal = task.get("goal")
-            monthly_stats = task.get("monthly_stats")
-
-            if not goal or not monthly_stats:
-                raise ValueError("Отсутствует goal или monthly_stats")
-
-            # --- Generate advice ---
-            advice_result = generate_advice(
-                goal=goal,
-                monthly_stats=monthly_stats,
-                model=ADVICE_MODEL,
-                schema_path=str(ADVICE_SCHEMA),
-                prompt_path=str(ADVICE_PROMPT)
-            )
-
-            logger.info(f"[{task_id}] Advice result: {json.dumps(advice_result, ensure_ascii=False)}")
-
-            final_result = {
-                "task_id": task_id,
-                "status": "SUCCESS",
-                "goal": goal.get("name"),
-                "advice": advice_result.get("advice", [])
-            }
-
-        except Exception as e:
-            logger.error(f"[{task_id}] Ошибка: {e}")
-            final_result = {
-                "task_id": task_id,
-                "status": "FAILED",
-                "error": str(e)
-            }
-            ch.basic_nack(method.delivery_tag)
-            return
-
-        # --- Publish result ---
-        channel.basic_publish(
-            exchange="",
-            routing_key=ADVICE_RESULTS_QUEUE,
-            body=json.dumps(final_result, ensure_ascii=False).encode("utf-8"),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
+    from src.core import rabbitmq
 
-        ch.basic_ack(method.delivery_tag)
-        logger.info(f"[{task_id}] Advice task обработана и отправлена")
+    logger.info(f"--- Запуск Advice Worker. RabbitMQ: {RABBITMQ_HOST} ---")
 
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=ADVICE_QUEUE, on_message_callback=process_task)
+    # Свойства результата неизменяемы — создаём один раз
+    result_properties = pika.BasicProperties(
+        delivery_mode=2, content_type="application/json"
+    )
+
+    # Пул живёт весь процесс: переподключение не пересоздаёт потоки
+    executor = ThreadPoolExecutor(max_workers=ADVICE_WORKERS)
+
+    def consume(connection):
+        channel, replies = rabbitmq.open_task_channels(
+            connection,
+            ADVICE_QUEUE,
+            ADVICE_RESULTS_QUEUE,
+            ADVICE_WORKERS * 2,
+            result_properties,
+        )
 
-    logger.info("Advice Worker запущен. Ожидание задач...")
-    channel.start_consuming()
+        def run_task(delivery_tag, body):
+            # Выполняется в пуле потоков: pika-объекты здесь трогать нельзя
+            task_id = "N/A"
+
+            # Ошибки разбора детерминированы: сообщение отклоняем без возврата в очередь
+            try:
+                task = orjson.loads(body)
+                if not isinstance(task, dict):
+                    raise ValueError(f"Задача должна быть объектом, получено {type(task).__name__}")
+                task_id = task.get("task_id", "N/A")
+
+                goal = task.get("goal")
+                monthly_stats = task.get("monthly_stats")
+
+                if not isinstance(goal, dict) or not goal or not monthly_stats:
+                    raise ValueError("Отсутствует goal или monthly_stats")
+            except Exception as e:
+                logger.error(f"[{task_id}] Задача отклонена: {e}")
+                replies.reject(delivery_tag)
+                return
+
+            try:
+                # --- Generate advice ---
+                advice_result = generate_advice(
+                    goal=goal,
+                    monthly_stats=monthly_stats,
+                    model=ADVICE_MODEL,
+                    schema_path=ADVICE_SCHEMA_PATH,
+                    prompt_path=ADVICE_PROMPT_PATH
+                )
+
+                # Полный результат пишем только с LOG_PAYLOADS; lazy — JSON собирается,
+                # только если debug-запись реально пишется
+                if LOG_PAYLOADS:
+                    logger.opt(lazy=True).debug(
+                        "[{}] Advice result: {}",
+                        lambda: task_id,
+                        lambda: orjson.dumps(advice_result).decode(),
+                    )
+
+                final_result = {
+                    "task_id": task_id,
+                    "status": "SUCCESS",
+                    "goal": goal.get("name"),
+                    "advice": advice_result.get("advice", [])
+                }
+                # Сериализуем здесь: ошибка в потоке соединения уронила бы весь воркер
+                result_body = orjson.dumps(final_result)
+
+            except Exception as e:
+                logger.error(f"[{task_id}] Ошибка: {e}")
+                replies.nack(delivery_tag)
+                return
+
+            # --- Publish result ---
+            replies.publish(delivery_tag, task_id, result_body)
+
+        def process_task(ch, method, properties, body):
+            logger.info("RAW advice message received")
+            executor.submit(run_task, method.delivery_tag, body)
+
+        channel.basic_consume(queue=ADVICE_QUEUE, on_message_callback=process_task)
+
+        logger.info("Advice Worker запущен. Ожидание задач...")
+        channel.start_consuming()
+
+    parameters = rabbitmq.connection_parameters(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS)
+    try:
+        rabbitmq.run_forever(parameters, consume)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,26 @@
-import json
+import base64
+import binascii
+import copy
+import hashlib
 import os
-import pika
-import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+
+import msgpack  # type: ignore[import-untyped]
+import orjson
+import pika
+
+from src.core import rabbitmq
+from src.core.config import LOG_PAYLOADS
 from src.core.logging import logger
-from src.services.ocr.ocr import extract_text_from_base64_image, categorize_items
+from src.services.ocr.ocr import (
+    categorize_items,
+    categorize_items_batch,
+    extract_text_from_image_bytes,
+)
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
@@ -14,6 +30,15 @@ RABBITMQ_PASS = os.getenv("RABBITMQ_PASS", "guest")
 
 OCR_MODEL = os.getenv("OCR_MODEL", "qwen3-vl:8b")
 BUDGET_MODEL = os.getenv("BUDGET_MODEL", "qwen3:14b")
+# Сколько задач обрабатывается параллельно (держать равным OLLAMA_NUM_PARALLEL)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+# Сколько задач собирать в одну пачку и сколько ждать недостающие (миллисекунды)
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "4"))
+OCR_BATCH_WINDOW = int(os.getenv("OCR_BATCH_WINDOW_MS", "50")) / 1000
+# prefetch на пачку для каждого потока: иначе пачки не успевают набираться
+OCR_PREFETCH = int(os.getenv("OCR_PREFETCH", str(OCR_WORKERS * OCR_BATCH_SIZE)))
+# Сколько результатов OCR/категоризации держать в кэше по хешу картинки
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "256"))
 
 OCR_SCHEMA = BASE_DIR / "src/services/ocr/schemas/ocr_schema.json"
 OCR_PROMPT = BASE_DIR / "src/services/ocr/prompts/ocr_prompt.txt"
@@ -22,25 +47,110 @@ OCR_PROMPT = BASE_DIR / "src/services/ocr/prompts/ocr_prompt.txt"
 CATEGORIZATION_SCHEMA_TEMPLATE = BASE_DIR / "src/services/ocr/schemas/categorize_schema.json"
 CATEGORIZATION_PROMPT = BASE_DIR / "src/services/ocr/prompts/categorize_prompt.txt"
 
+# Сервисы принимают пути строками — переводим один раз, а не на каждую задачу
+OCR_SCHEMA_PATH = str(OCR_SCHEMA)
+OCR_PROMPT_PATH = str(OCR_PROMPT)
+CATEGORIZATION_PROMPT_PATH = str(CATEGORIZATION_PROMPT)
+
+# Категории по умолчанию, если в задаче их нет или они невалидны
+_DEFAULT_CATEGORIES = ("Groceries", "Dining", "Transport", "Entertainment", "Other", "Unknown")
+
 OCR_QUEUE = "ocr_tasks"
 OCR_RESULTS_QUEUE = "ocr_results"
 
+# Персистентные результаты брокер пишет на диск; OCR_RESULTS_DURABLE=0 — transient,
+# если потеря результата при падении брокера допустима
+OCR_RESULTS_DURABLE = os.getenv("OCR_RESULTS_DURABLE", "1").lower() not in ("0", "false", "no")
+_RESULT_PROPERTIES = pika.BasicProperties(delivery_mode=2 if OCR_RESULTS_DURABLE else 1)
+
+# Бинарный формат задачи: {"task_id", "image": <bytes>, "categories"} без base64
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+# Шаблон не меняется во время работы — читаем и парсим один раз
+_SCHEMA_TEMPLATE = orjson.loads(CATEGORIZATION_SCHEMA_TEMPLATE.read_bytes())
+
+
+@lru_cache(maxsize=32)
+def _schema_for_categories(categories: tuple[str, ...]) -> dict:
+    schema = copy.deepcopy(_SCHEMA_TEMPLATE)
+    schema["properties"]["items"]["items"]["properties"]["Category"]["enum"] = list(categories)
+    return schema
+
 
 def load_schema_with_enum(categories: list[str]) -> dict:
     """
-    Загружает схему категоризации и подставляет enum.
+    Возвращает схему категоризации с подставленным enum.
     Схема должна содержать ТОЛЬКО поле Category.
+    Результат кэшируется по набору категорий — не изменять.
     """
-    schema_text = CATEGORIZATION_SCHEMA_TEMPLATE.read_text(encoding="utf-8")
-    schema = json.loads(schema_text)
-    schema["properties"]["items"]["items"]["properties"]["Category"]["enum"] = categories
-    return schema
+    return _schema_for_categories(tuple(categories))
+
+
+# Большинство задач идёт с категориями по умолчанию — их схему собираем заранее
+_DEFAULT_SCHEMA = _schema_for_categories(_DEFAULT_CATEGORIES)
+
+
+class ResultCache:
+    """
+    Потокобезопасный LRU-кэш результатов LLM.
+    Хранит JSON-байты: каждый get() отдаёт свежий dict, который можно менять.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: OrderedDict[object, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: object) -> dict | None:
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                return None
+            self._data.move_to_end(key)
+        return orjson.loads(data)
+
+    def put(self, key: object, value: dict) -> None:
+        data = orjson.dumps(value)
+        with self._lock:
+            self._data[key] = data
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key: object) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# Повторные загрузки одного и того же чека (ретраи, дубли) не гоняем через LLM
+_ocr_cache = ResultCache(OCR_CACHE_SIZE)
+_category_cache = ResultCache(OCR_CACHE_SIZE)
+
+
+class InvalidTaskError(ValueError):
+    """
+    Задача некорректна сама по себе (нет картинки, битый task_id и т.п.).
+    Повтор не поможет — такое сообщение не возвращается в очередь.
+    """
+
+
+def parse_task(body: bytes, content_type: str | None) -> dict:
+    """
+    Разбирает сообщение задачи.
+    MessagePack-сообщения несут картинку сырыми байтами в поле image,
+    остальные считаются JSON с полем image_b64.
+    """
+    if content_type in MSGPACK_CONTENT_TYPES:
+        return msgpack.unpackb(body, raw=False)
+    return orjson.loads(body)
 
 
 def merge_categories(ocr_result: dict, category_result: dict) -> dict:
     """
     Склеивает OCR items + Category от LLM.
     Гарантирует валидный финальный объект.
+    Category дописывается прямо в items из ocr_result (он больше нигде не нужен).
     """
     ocr_items = ocr_result.get("items", [])
     cat_items = category_result.get("items", [])
@@ -48,124 +158,314 @@ def merge_categories(ocr_result: dict, category_result: dict) -> dict:
     if len(ocr_items) != len(cat_items):
         raise ValueError("Количество items в OCR и категоризации не совпадает")
 
-    merged_items = []
     for ocr_item, cat_item in zip(ocr_items, cat_items):
-        merged_items.append({
-            **ocr_item,
-            "Category": cat_item.get("Category", "Unknown")
-        })
+        ocr_item["Category"] = cat_item.get("Category", "Unknown")
 
-    return {"items": merged_items}
+    return {"items": ocr_items}
 
 
-def start_ocr_worker():
-    logger.info(f"--- Запуск OCR Worker. Подключение к RabbitMQ на {RABBITMQ_HOST} ---")
+def task_categories(task: dict) -> tuple[list[str], dict]:
+    """
+    Категории задачи и схема категоризации для них.
+    Если категорий нет или они невалидны — категории по умолчанию.
+    """
+    raw_categories = task.get("categories")
+    if (
+        isinstance(raw_categories, list)
+        and raw_categories
+        # type() is: точное сравнение типа, без обхода MRO; стоп на первом не-str
+        and all(type(c) is str for c in raw_categories)
+    ):
+        return raw_categories, load_schema_with_enum(raw_categories)
+    return list(_DEFAULT_CATEGORIES), _DEFAULT_SCHEMA
+
+
+def task_image(task: dict) -> bytes:
+    """
+    Картинка задачи: сырые байты из image или декодированный image_b64.
+    bytes в image бывают только в msgpack-задачах; в JSON image — строка
+    (например, имя файла), её не используем.
+    """
+    image = task.get("image")
+    if isinstance(image, bytes) and image:
+        return image
 
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=RABBITMQ_HOST,
-                port=5672,
-                credentials=credentials,
-                heartbeat=60000
-            )
+    image_b64 = task.get("image_b64")
+    if isinstance(image_b64, str) and image_b64:
+        try:
+            return base64.b64decode(image_b64)
+        except binascii.Error as e:
+            raise InvalidTaskError(f"image_b64 не является Base64: {e}") from e
+    raise InvalidTaskError(
+        "Нет картинки: нужно image_b64 (строка Base64) или image (байты, только msgpack)"
+    )
+
+
+def run_ocr(task_id: str, image: bytes, digest: str) -> dict:
+    """OCR картинки с кэшем по её содержимому."""
+    ocr_result = _ocr_cache.get(digest)
+    if ocr_result is None:
+        ocr_result = extract_text_from_image_bytes(
+            image=image,
+            model=OCR_MODEL,
+            schema_path=OCR_SCHEMA_PATH,
+            prompt_path=OCR_PROMPT_PATH
         )
-    except pika.exceptions.AMQPConnectionError as e:
-        logger.error(f"Не удалось подключиться к RabbitMQ: {e}")
-        return
-
-    channel = connection.channel()
-    channel.queue_declare(queue=OCR_QUEUE, durable=True)
-    channel.queue_declare(queue=OCR_RESULTS_QUEUE, durable=True)
+        _ocr_cache.put(digest, ocr_result)
+    else:
+        logger.info(f"[{task_id}] OCR result взят из кэша ({digest})")
+    # Полный результат пишем только с LOG_PAYLOADS; lazy — JSON собирается,
+    # только если debug-запись реально пишется
+    if LOG_PAYLOADS:
+        logger.opt(lazy=True).debug(
+            "[{}] OCR result: {}", lambda: task_id, lambda: orjson.dumps(ocr_result).decode()
+        )
+    return ocr_result
 
-    def process_task(ch, method, properties, body):
-        logger.info("RAW message received")
 
-        task_id = "N/A"
+def run_categorization(categories: list[str], schema: dict, ocr_results: list[dict]) -> list:
+    """
+    Категоризация чеков с одним набором категорий.
+    Несколько чеков идут одним запросом к LLM; если пачка не удалась или
+    для какого-то чека вернулось не то число items, такие чеки
+    категоризуются по одному. Возвращает результат или исключение на каждый чек.
+    """
+    results: list = [None] * len(ocr_results)
+    if len(ocr_results) > 1:
         try:
-            task = json.loads(body.decode())
-            task_id = task.get("task_id", "N/A")
-
-            # --- Categories ---
-            raw_categories = task.get("categories")
-            if isinstance(raw_categories, list) and all(isinstance(c, str) for c in raw_categories):
-                categories = raw_categories
-            else:
-                categories = ["Groceries", "Dining", "Transport", "Entertainment", "Other", "Unknown"]
-
-            logger.info(f"[{task_id}] Using categories: {categories}")
-
-            # --- Image ---
-            image_b64 = task.get("image_b64")
-            if not image_b64:
-                raise ValueError("Отсутствует поле image_b64")
-
-            # --- OCR ---
-            ocr_result = extract_text_from_base64_image(
-                image_b64=image_b64,
-                model=OCR_MODEL,
-                schema_path=str(OCR_SCHEMA),
-                prompt_path=str(OCR_PROMPT)
+            results = categorize_items_batch(
+                ocr_results=ocr_results,
+                categories=categories,
+                model=BUDGET_MODEL,
+                schema=schema,
+                prompt_path=CATEGORIZATION_PROMPT_PATH
             )
-            logger.info(f"[{task_id}] OCR result: {json.dumps(ocr_result, ensure_ascii=False)}")
-
-            # --- Categorization schema (TEMP FILE) ---
-            categorization_schema_json = load_schema_with_enum(categories)
-            with tempfile.NamedTemporaryFile(
-                "w", delete=False, suffix=".json", encoding="utf-8"
-            ) as tmp_file:
-                json.dump(categorization_schema_json, tmp_file, ensure_ascii=False, indent=2)
-                tmp_schema_path = tmp_file.name
-
-            # --- Categorization (ONLY Category) ---
-            category_result = categorize_items(
+        except Exception as e:
+            logger.warning(f"Пакетная категоризация не удалась ({e}), категоризуем по одному")
+
+    for index, ocr_result in enumerate(ocr_results):
+        category_result = results[index]
+        if isinstance(category_result, dict) and (
+            len(category_result.get("items", [])) == len(ocr_result.get("items", []))
+        ):
+            continue
+        try:
+            results[index] = categorize_items(
                 ocr_result=ocr_result,
                 categories=categories,
                 model=BUDGET_MODEL,
-                schema_path=tmp_schema_path,
-                prompt_path=str(CATEGORIZATION_PROMPT)
+                schema=schema,
+                prompt_path=CATEGORIZATION_PROMPT_PATH
             )
+        except Exception as e:
+            results[index] = e
+    return results
 
-            logger.info(
-                f"[{task_id}] Category result: {json.dumps(category_result, ensure_ascii=False)}"
-            )
 
-            # --- Merge ---
-            final_items = merge_categories(ocr_result, category_result)
+def ocr_task(task_id: str, task: dict) -> tuple[list[str], dict, dict]:
+    """
+    Категории, схема категоризации и OCR одной задачи.
+    Выполняется в пуле OCR — задачи пачки распознаются параллельно.
+    """
+    categories, schema = task_categories(task)
+    logger.info(f"[{task_id}] Using categories: {categories}")
 
-            final_result = {
-                "task_id": task_id,
-                "status": "SUCCESS",
-                "data": final_items
-            }
+    image = task_image(task)
+    digest = hashlib.blake2b(image, digest_size=16).hexdigest()
+    return categories, schema, run_ocr(task_id, image, digest)
+
+
+def process_ocr_batch(tasks: list[tuple[str, dict]], ocr_executor: ThreadPoolExecutor) -> list:
+    """
+    OCR + категоризация пачки задач [(task_id, task), ...].
+    OCR каждой задачи идёт отдельно в ocr_executor, пачкой — только категоризация:
+    чеки с одинаковым набором категорий категоризуются одним запросом к LLM.
+    Возвращает на каждую задачу {"items": [...]} или исключение, в том же порядке.
+    """
+    results: list = [None] * len(tasks)
+    # tuple(categories) -> (categories, schema, [(index, task_id, ocr_result, cache_key)])
+    groups: dict[tuple[str, ...], tuple[list[str], dict, list]] = {}
 
+    futures = [ocr_executor.submit(ocr_task, task_id, task) for task_id, task in tasks]
+    for index, ((task_id, _), future) in enumerate(zip(tasks, futures)):
+        try:
+            categories, schema, ocr_result = future.result()
+
+            # Пустой чек: категоризовать нечего, LLM не зовём
+            if not ocr_result.get("items"):
+                logger.info(f"[{task_id}] OCR не нашёл items, категоризация пропущена")
+                results[index] = {"items": []}
+                continue
+
+            # Ключ — сами items: повторный OCR той же картинки может дать другой список
+            items_digest = hashlib.blake2b(
+                orjson.dumps(ocr_result["items"]), digest_size=16
+            ).hexdigest()
+            category_key = (items_digest, tuple(categories))
+            category_result = _category_cache.get(category_key)
+            if category_result is not None:
+                try:
+                    results[index] = merge_categories(ocr_result, category_result)
+                    continue
+                except Exception:
+                    logger.warning(f"[{task_id}] Категории из кэша не подходят, запрашиваем заново")
+                    _category_cache.discard(category_key)
         except Exception as e:
-            logger.error(f"[{task_id}] Ошибка: {e}")
+            results[index] = e
+            continue
+
+        group = groups.setdefault(category_key[1], (categories, schema, []))
+        group[2].append((index, task_id, ocr_result, category_key))
+
+    # --- Categorization (ONLY Category) ---
+    for categories, schema, jobs in groups.values():
+        category_results = run_categorization(
+            categories, schema, [ocr_result for _, _, ocr_result, _ in jobs]
+        )
+        for (index, task_id, ocr_result, category_key), category_result in zip(
+            jobs, category_results
+        ):
+            if isinstance(category_result, Exception):
+                results[index] = category_result
+                continue
+            if LOG_PAYLOADS:
+                logger.opt(lazy=True).debug(
+                    "[{}] Category result: {}",
+                    lambda: task_id,
+                    lambda: orjson.dumps(category_result).decode(),
+                )
+            # --- Merge ---
+            # Любая ошибка (в т.ч. ответ LLM не того вида) — только у этой задачи
+            try:
+                results[index] = merge_categories(ocr_result, category_result)
+            except Exception as e:
+                results[index] = e
+                continue
+            # В кэш — только ответ, который реально подошёл к items
+            _category_cache.put(category_key, category_result)
+
+    return results
+
+
+def consume(
+    connection, batch_executor: ThreadPoolExecutor, ocr_executor: ThreadPoolExecutor
+) -> None:
+    """Обслуживает одно соединение до его разрыва."""
+    consume_channel, replies = rabbitmq.open_task_channels(
+        connection, OCR_QUEUE, OCR_RESULTS_QUEUE, OCR_PREFETCH, _RESULT_PROPERTIES
+    )
+
+    def run_batch(batch):
+        # Выполняется в пуле потоков: pika-объекты здесь трогать нельзя
+        tasks = []
+        for delivery_tag, content_type, body in batch:
+            # Ошибки разбора детерминированы: сообщение отклоняем без возврата в очередь
+            try:
+                task = parse_task(body, content_type)
+                if not isinstance(task, dict):
+                    raise InvalidTaskError(
+                        f"Задача должна быть объектом, получено {type(task).__name__}"
+                    )
+                task_id = task.get("task_id", "N/A")
+                # msgpack пропускает и bytes, и что угодно — в JSON-результат это не ляжет
+                if not isinstance(task_id, str):
+                    raise InvalidTaskError(
+                        f"task_id должен быть строкой, получено {type(task_id).__name__}"
+                    )
+                tasks.append((delivery_tag, task_id, task))
+            except Exception as e:
+                logger.error(f"[N/A] Задача отклонена: {e}")
+                replies.reject(delivery_tag)
+
+        try:
+            results = process_ocr_batch(
+                [(task_id, task) for _, task_id, task in tasks], ocr_executor
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обработки пачки: {e}")
+            results = [e] * len(tasks)
+
+        # Ответ на каждую задачу отдельно: ack с multiple=True подтвердил бы
+        # и задачи из других пачек, которые ещё обрабатываются в соседних потоках
+        for (delivery_tag, task_id, _), result in zip(tasks, results):
+            if isinstance(result, InvalidTaskError):
+                logger.error(f"[{task_id}] Задача отклонена: {result}")
+                replies.reject(delivery_tag)
+                continue
+            if isinstance(result, Exception):
+                # Например, Ollama недоступна — задачу стоит повторить
+                logger.error(f"[{task_id}] Ошибка: {result}")
+                replies.nack(delivery_tag)
+                continue
+
             final_result = {
                 "task_id": task_id,
-                "status": "FAILED",
-                "error": str(e)
+                "status": "SUCCESS",
+                "data": result
             }
-            ch.basic_nack(method.delivery_tag)
-            return
-
-        # --- Publish ---
-        channel.basic_publish(
-            exchange="",
-            routing_key=OCR_RESULTS_QUEUE,
-            body=json.dumps(final_result, ensure_ascii=False).encode("utf-8"),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
+            # Сериализуем здесь: ошибка в потоке соединения уронила бы весь воркер
+            try:
+                body = orjson.dumps(final_result)
+            except TypeError as e:
+                logger.error(f"[{task_id}] Результат не сериализуется: {e}")
+                replies.reject(delivery_tag)
+                continue
+
+            # --- Publish ---
+            replies.publish(delivery_tag, task_id, body)
+
+    # Сообщения копятся здесь (поток соединения), пока не наберётся пачка
+    # или не истечёт OCR_BATCH_WINDOW с первого сообщения пачки
+    pending: list[tuple[int, str | None, bytes]] = []
+    flush_timer = None
+
+    def flush():
+        nonlocal flush_timer
+        if flush_timer is not None:
+            connection.remove_timeout(flush_timer)
+            flush_timer = None
+        batch = pending[:]
+        pending.clear()
+        batch_executor.submit(run_batch, batch)
+
+    def on_flush_timer():
+        nonlocal flush_timer
+        flush_timer = None
+        if pending:
+            flush()
 
-        ch.basic_ack(method.delivery_tag)
-        logger.info(f"[{task_id}] Задача обработана и результат отправлен.")
+    def process_task(ch, method, properties, body):
+        nonlocal flush_timer
+        logger.info("RAW message received")
+        pending.append((method.delivery_tag, properties.content_type, body))
+        if len(pending) >= OCR_BATCH_SIZE:
+            flush()
+        elif flush_timer is None:
+            flush_timer = connection.call_later(OCR_BATCH_WINDOW, on_flush_timer)
 
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=OCR_QUEUE, on_message_callback=process_task)
+    consume_channel.basic_consume(queue=OCR_QUEUE, on_message_callback=process_task)
 
     logger.info("OCR Worker запущен. Ожидание задач...")
-    channel.start_consuming()
+    consume_channel.start_consuming()
+
+
+def start_ocr_worker():
+    logger.info(f"--- Запуск OCR Worker. Подключение к RabbitMQ на {RABBITMQ_HOST} ---")
+
+    parameters = rabbitmq.connection_parameters(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS)
+
+    # Пулы живут весь процесс: переподключение не пересоздаёт потоки и кэши.
+    # OCR_WORKERS потоков OCR на все пачки; потоки пачек в основном ждут OCR
+    # и делают пакетную категоризацию
+    ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    batch_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+    try:
+        rabbitmq.run_forever(
+            parameters, lambda connection: consume(connection, batch_executor, ocr_executor)
+        )
+    finally:
+        batch_executor.shutdown(wait=False, cancel_futures=True)
+        ocr_executor.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == "__main__":
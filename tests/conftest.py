@@ -0,0 +1,64 @@
+import base64
+import io
+
+import orjson
+import pytest
+from PIL import Image
+
+from src.core import ollama
+
+
+def make_png(color: tuple[int, int, int]) -> bytes:
+    """A tiny PNG; small enough that downscale_image passes it through unchanged."""
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class FakeOllama:
+    """
+    Stand-in for ollama.chat.
+    OCR requests (with an image) answer ocr_items[image]; categorization
+    requests answer every item with `category`, one result per receipt for
+    batch requests. `batch_reply` / `single_reply` override those answers.
+    """
+
+    def __init__(self):
+        self.ocr_items: dict[bytes, list[dict]] = {}
+        self.category = "Groceries"
+        self.batch_reply = None
+        self.single_reply = None
+        self.calls: list[str] = []
+
+    def chat(self, model: str, messages: list[dict], schema: dict) -> dict:
+        images = messages[-1].get("images")
+        if images:
+            self.calls.append("ocr")
+            items = self.ocr_items[base64.b64decode(images[0])]
+            return {"items": [dict(item) for item in items]}
+
+        if "results" in schema["properties"]:
+            self.calls.append("batch")
+            count = schema["properties"]["results"]["minItems"]
+            if self.batch_reply is not None:
+                return self.batch_reply(count)
+            receipts = orjson.loads(messages[-1]["content"].rsplit("\n", 1)[1])
+            return {
+                "results": [
+                    {"items": [{"Category": self.category} for _ in receipt["items"]]}
+                    for receipt in receipts["receipts"]
+                ]
+            }
+
+        self.calls.append("single")
+        if self.single_reply is not None:
+            return self.single_reply()
+        items = orjson.loads(messages[-1]["content"].rsplit("Items:\n", 1)[1])
+        return {"items": [{"Category": self.category} for _ in items["items"]]}
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    fake = FakeOllama()
+    monkeypatch.setattr(ollama, "chat", fake.chat)
+    return fake
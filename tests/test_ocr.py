@@ -0,0 +1,38 @@
+import pytest
+
+from src.core import ollama
+from src.services.ocr import categorize_items_batch
+
+SCHEMA = {
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "type": "object",
+    "properties": {"items": {"type": "array"}},
+}
+PROMPT = "src/services/ocr/prompts/categorize_prompt.txt"
+
+
+def test_categorize_items_batch_wraps_schema_per_receipt(fake_ollama, monkeypatch):
+    schemas = []
+
+    def chat(model, messages, schema):
+        schemas.append(schema)
+        return fake_ollama.chat(model, messages, schema)
+
+    monkeypatch.setattr(ollama, "chat", chat)
+    results = categorize_items_batch(
+        [{"items": [{"Name": "a"}]}, {"items": []}], ["Groceries"], "m", SCHEMA, PROMPT
+    )
+
+    results_schema = schemas[0]["properties"]["results"]
+    assert results_schema["minItems"] == results_schema["maxItems"] == 2
+    assert "$schema" not in results_schema["items"]
+    assert results == [{"items": [{"Category": "Groceries"}]}, {"items": []}]
+
+
+def test_categorize_items_batch_rejects_wrong_result_count(fake_ollama):
+    fake_ollama.batch_reply = lambda count: {"results": [{"items": []}]}
+
+    with pytest.raises(ValueError):
+        categorize_items_batch(
+            [{"items": []}, {"items": []}], ["Groceries"], "m", SCHEMA, PROMPT
+        )
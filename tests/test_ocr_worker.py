@@ -0,0 +1,238 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack  # type: ignore[import-untyped]
+import orjson
+import pytest
+
+from src.workers import ocr_worker
+from tests.conftest import make_png
+
+RED = make_png((255, 0, 0))
+GREEN = make_png((0, 255, 0))
+BLUE = make_png((0, 0, 255))
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches(monkeypatch):
+    monkeypatch.setattr(ocr_worker, "_ocr_cache", ocr_worker.ResultCache(16))
+    monkeypatch.setattr(ocr_worker, "_category_cache", ocr_worker.ResultCache(16))
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+
+def run(tasks, executor):
+    return ocr_worker.process_ocr_batch(
+        [(task_id, task) for task_id, task in tasks], executor
+    )
+
+
+# --- ResultCache ---
+
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ocr_worker.ResultCache(2)
+    cache.put("a", {"v": 1})
+    cache.put("b", {"v": 2})
+    cache.get("a")
+    cache.put("c", {"v": 3})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"v": 1}
+    assert cache.get("c") == {"v": 3}
+
+
+def test_result_cache_returns_fresh_copies():
+    cache = ocr_worker.ResultCache(2)
+    cache.put("a", {"items": [{"Name": "x"}]})
+    cache.get("a")["items"][0]["Category"] = "Other"
+
+    assert cache.get("a") == {"items": [{"Name": "x"}]}
+
+    cache.discard("a")
+    assert cache.get("a") is None
+
+
+# --- parse_task / task_image ---
+
+
+def test_parse_task_dispatches_on_content_type():
+    task = {"task_id": "t", "image": RED}
+
+    assert ocr_worker.parse_task(msgpack.packb(task), "application/msgpack") == task
+    assert ocr_worker.parse_task(b'{"task_id": "t"}', None) == {"task_id": "t"}
+    assert ocr_worker.parse_task(b'{"task_id": "t"}', "application/json") == {
+        "task_id": "t"
+    }
+
+
+def test_task_image_prefers_msgpack_bytes():
+    assert ocr_worker.task_image({"image": RED}) == RED
+
+
+def test_task_image_ignores_string_image_field():
+    task = {"image": "receipt.jpg", "image_b64": base64.b64encode(RED).decode()}
+
+    assert ocr_worker.task_image(task) == RED
+
+
+@pytest.mark.parametrize(
+    "task", [{}, {"image": "receipt.jpg"}, {"image_b64": 123}, {"image_b64": "a"}]
+)
+def test_task_image_rejects_missing_or_broken_image(task):
+    with pytest.raises(ocr_worker.InvalidTaskError):
+        ocr_worker.task_image(task)
+
+
+# --- process_ocr_batch ---
+
+
+def test_batch_runs_ocr_per_task_and_one_categorization(fake_ollama, executor):
+    fake_ollama.ocr_items = {
+        RED: [{"Name": "bread"}],
+        GREEN: [{"Name": "milk"}, {"Name": "eggs"}],
+        BLUE: [{"Name": "tea"}],
+    }
+
+    results = run(
+        [("r", {"image": RED}), ("g", {"image": GREEN}), ("b", {"image": BLUE})],
+        executor,
+    )
+
+    assert fake_ollama.calls.count("ocr") == 3
+    assert fake_ollama.calls.count("batch") == 1
+    assert "single" not in fake_ollama.calls
+    assert results[1] == {
+        "items": [
+            {"Name": "milk", "Category": "Groceries"},
+            {"Name": "eggs", "Category": "Groceries"},
+        ]
+    }
+
+
+def test_batch_groups_by_category_set(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}], GREEN: [{"Name": "b"}]}
+
+    run(
+        [
+            ("r", {"image": RED}),
+            ("g", {"image": GREEN, "categories": ["Food", "Other"]}),
+        ],
+        executor,
+    )
+
+    assert fake_ollama.calls.count("single") == 2
+    assert "batch" not in fake_ollama.calls
+
+
+def test_batch_falls_back_to_single_requests_on_wrong_count(fake_ollama, executor):
+    fake_ollama.ocr_items = {
+        RED: [{"Name": "a"}],
+        GREEN: [{"Name": "b"}, {"Name": "c"}],
+    }
+    # Receipt 1 gets one item instead of two
+    fake_ollama.batch_reply = lambda count: {
+        "results": [{"items": [{"Category": "Dining"}]} for _ in range(count)]
+    }
+
+    results = run([("r", {"image": RED}), ("g", {"image": GREEN})], executor)
+
+    assert fake_ollama.calls.count("single") == 1
+    assert results[0] == {"items": [{"Name": "a", "Category": "Dining"}]}
+    assert [item["Category"] for item in results[1]["items"]] == [
+        "Groceries",
+        "Groceries",
+    ]
+
+
+def test_failed_batch_request_is_categorized_one_by_one(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}], GREEN: [{"Name": "b"}]}
+    fake_ollama.batch_reply = lambda count: {"results": []}
+
+    results = run([("r", {"image": RED}), ("g", {"image": GREEN})], executor)
+
+    assert fake_ollama.calls.count("single") == 2
+    assert all(not isinstance(result, Exception) for result in results)
+
+
+def test_malformed_answer_fails_only_its_own_task(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}], GREEN: [{"Name": "b"}]}
+    fake_ollama.batch_reply = lambda count: {
+        "results": [{"items": [{"Category": "Other"}]}, {"items": ["junk"]}]
+    }
+
+    results = run([("r", {"image": RED}), ("g", {"image": GREEN})], executor)
+
+    assert results[0] == {"items": [{"Name": "a", "Category": "Other"}]}
+    assert isinstance(results[1], Exception)
+
+
+def test_empty_receipt_skips_categorization(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: []}
+
+    assert run([("r", {"image": RED})], executor) == [{"items": []}]
+    assert fake_ollama.calls == ["ocr"]
+
+
+def test_invalid_task_fails_alone(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}]}
+
+    results = run([("bad", {"image": "receipt.jpg"}), ("r", {"image": RED})], executor)
+
+    assert isinstance(results[0], ocr_worker.InvalidTaskError)
+    assert results[1] == {"items": [{"Name": "a", "Category": "Groceries"}]}
+
+
+# --- caches ---
+
+
+def test_repeated_image_is_served_from_caches(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}]}
+
+    first = run([("r", {"image": RED})], executor)
+    second = run([("r2", {"image": RED})], executor)
+
+    assert first == second
+    assert fake_ollama.calls == ["ocr", "single"]
+
+
+def test_category_cache_follows_ocr_items_not_image(fake_ollama, executor, monkeypatch):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}]}
+    run([("r", {"image": RED})], executor)
+
+    # Same image, OCR evicted and re-run with a different item list
+    monkeypatch.setattr(ocr_worker, "_ocr_cache", ocr_worker.ResultCache(16))
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}, {"Name": "b"}]}
+    results = run([("r", {"image": RED})], executor)
+
+    assert fake_ollama.calls == ["ocr", "single", "ocr", "single"]
+    assert len(results[0]["items"]) == 2
+
+
+def test_short_answer_is_not_cached(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}, {"Name": "b"}]}
+    fake_ollama.single_reply = lambda: {"items": [{"Category": "Other"}]}
+
+    assert isinstance(run([("r", {"image": RED})], executor)[0], ValueError)
+
+    fake_ollama.single_reply = None
+    results = run([("r", {"image": RED})], executor)
+
+    assert fake_ollama.calls.count("single") == 2
+    assert len(results[0]["items"]) == 2
+
+
+def test_stale_category_entry_is_dropped(fake_ollama, executor):
+    fake_ollama.ocr_items = {RED: [{"Name": "a"}]}
+    run([("r", {"image": RED})], executor)
+    key = next(iter(ocr_worker._category_cache._data))
+    ocr_worker._category_cache._data[key] = orjson.dumps({"items": []})
+
+    results = run([("r", {"image": RED})], executor)
+
+    assert results[0] == {"items": [{"Name": "a", "Category": "Groceries"}]}
+    assert fake_ollama.calls.count("single") == 2